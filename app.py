@@ -4,7 +4,7 @@
 # go to thunder client and set request to get: http://localhost:5000/get_report?report_id={report_id}
 # check for reports in the folder
 
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, request, send_file, jsonify, g, has_app_context
 import sqlite3
 import uuid
 import csv
@@ -13,21 +13,126 @@ import pytz
 import os
 from apscheduler.schedulers.background import BackgroundScheduler
 import traceback
+import threading
+from collections import defaultdict
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import repeat, islice
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 
 app = Flask(__name__)
 
-#setup db
+#report windows in seconds, timestamps are unix seconds inside the report pipeline
+HOUR = 3600
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+REPORT_WINDOWS = (HOUR, DAY, WEEK)
+
+#23:59:59 as seconds since midnight, treated as open until midnight
+END_OF_DAY = DAY - 1
+
+#business hours table for a store open all day every day
+ALWAYS_OPEN = [[(0, DAY)] for _ in range(7)]
+
+#naive local times are handled as seconds since this
+LOCAL_EPOCH = datetime(1970, 1, 1)
+
+#stores handed to a report worker process per task
+REPORT_CHUNK_SIZE = 500
+
+_report_executor = None
+_report_executor_lock = threading.Lock()
+
+#multi-row inserts when loading csvs, capped by sqlite's default bound parameter limit
+INSERT_BATCH_ROWS = 500
+SQLITE_MAX_VARIABLES = 999
+
+#report queries kept as constants so sqlite's statement cache always gets the same text
+LATEST_PING_SQL = 'SELECT MAX(timestamp_utc) FROM store_status'
+TIMEZONES_SQL = 'SELECT store_id, timezone_str FROM timezones'
+BUSINESS_HOURS_SQL = 'SELECT store_id, day_of_week, start_time_local, end_time_local FROM business_hours'
+STORE_PINGS_SQL = '''
+    SELECT store_id, timestamp_utc, status FROM store_status WHERE timestamp_utc >= ?
+    UNION ALL
+    SELECT store_id, MAX(timestamp_utc), status FROM store_status WHERE timestamp_utc < ? GROUP BY store_id
+    ORDER BY store_id, timestamp_utc
+'''
+
+DB_PRAGMAS = [
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA busy_timeout=5000',
+]
+
+_wal_enabled = False
+
+_thread_db = threading.local()
+
+_db_ready = False
+_db_init_lock = threading.Lock()
+
+#setup db, one connection per request or per thread outside a request (the scheduler thread)
 def get_db():
+    ensure_db()
+    if has_app_context():
+        if 'db' not in g:
+            g.db = connect_db()
+        return g.db
+
+    db = getattr(_thread_db, 'db', None)
+    if db is None:
+        db = _thread_db.db = connect_db()
+    return db
+
+@app.teardown_appcontext
+def close_db(exception):
+    db = g.pop('db', None)
+    if db is not None:
+        db.close()
+
+def connect_db():
+    global _wal_enabled
     db = sqlite3.connect('store_monitoring.db')
     db.row_factory = sqlite3.Row
+
+    #journal_mode is stored in the db file so it only needs setting once
+    if not _wal_enabled:
+        db.execute('PRAGMA journal_mode=WAL')
+        _wal_enabled = True
+    for pragma in DB_PRAGMAS:
+        db.execute(pragma)
     return db
 
 #init db
+#tables and csv data are set up by the first connection a process asks for, report workers never ask
+def ensure_db():
+    global _db_ready
+    if _db_ready:
+        return
+
+    with _db_init_lock:
+        if not _db_ready:
+            init_db()
+            _db_ready = True
+
 def init_db():
-    db = get_db()
+    db = connect_db()
+    try:
+        create_tables(db)
+        load_csv_data(db)
+        db.execute('ANALYZE')
+        db.commit()
+    finally:
+        db.close()
+
+def create_tables(db):
     cursor = db.cursor()
 
-    #create 4 tables
+    #create 4 tables and the indexes used by report generation
     cursor.executescript('''
         CREATE TABLE IF NOT EXISTS store_status (
             store_id TEXT,
@@ -52,10 +157,14 @@ def init_db():
             status TEXT,
             csv_path TEXT
         );
+
+        CREATE INDEX IF NOT EXISTS idx_status_store_ts ON store_status (store_id, timestamp_utc);
+        CREATE INDEX IF NOT EXISTS idx_status_ts ON store_status (timestamp_utc);
+        CREATE INDEX IF NOT EXISTS idx_bh_store ON business_hours (store_id);
+        CREATE INDEX IF NOT EXISTS idx_tz_store ON timezones (store_id);
     ''')
 
     db.commit()
-    load_csv_data(db)
 
 def load_csv_data(db):
     csv_files = {
@@ -64,36 +173,60 @@ def load_csv_data(db):
         'timezones.csv': ('timezones', ['store_id', 'timezone_str'])
     }
 
-    for filename, (table_name, columns) in csv_files.items():
-        file_path = os.path.join(os.getcwd(), filename)
-        if not os.path.exists(file_path):
-            app.logger.warning(f"Warning: {filename} not found. Skipping...")
-            continue
+    #one transaction for all files instead of a commit per table
+    with db:
+        for filename, (table_name, columns) in csv_files.items():
+            file_path = os.path.join(os.getcwd(), filename)
+            if not os.path.exists(file_path):
+                app.logger.warning(f"Warning: {filename} not found. Skipping...")
+                continue
 
-        app.logger.info(f"Loading data from {filename} into {table_name} table...")
-        
-        with open(file_path, 'r') as csvfile:
-            csv_reader = csv.DictReader(csvfile)
-            to_db = []
-            for row in csv_reader:
-                to_db.append(tuple(row[col] for col in columns))
-
-        placeholders = ','.join(['?' for _ in columns])
-        db.executemany(
-            f"INSERT INTO {table_name} ({','.join(columns)}) VALUES ({placeholders})",
-            to_db
-        )
-        
-        db.commit()
-        app.logger.info(f"Loaded {len(to_db)} rows into {table_name} table.")
+            app.logger.info(f"Loading data from {filename} into {table_name} table...")
+            
+            placeholders = f"({','.join(['?' for _ in columns])})"
+            batch_size = min(INSERT_BATCH_ROWS, SQLITE_MAX_VARIABLES // len(columns))
+            loaded = 0
+            with open(file_path, 'r', newline='') as csvfile:
+                csv_reader = csv.reader(csvfile)
+                header = next(csv_reader, None)
+                if header is None:
+                    app.logger.warning(f"Warning: {filename} is empty. Skipping...")
+                    continue
+                col_idx = [header.index(col) for col in columns]
 
-    app.logger.info("CSV data loading complete.")
+                #rows are streamed from the reader and inserted batch_size rows per statement
+                #blank lines are skipped and short rows padded with None, as DictReader did
+                rows = (
+                    tuple(row[i] if i < len(row) else None for i in col_idx)
+                    for row in csv_reader if row
+                )
+                while batch := list(islice(rows, batch_size)):
+                    db.execute(
+                        f"INSERT INTO {table_name} ({','.join(columns)}) VALUES {','.join([placeholders] * len(batch))}",
+                        [value for row in batch for value in row]
+                    )
+                    loaded += len(batch)
+            
+            app.logger.info(f"Loaded {loaded} rows into {table_name} table.")
 
-init_db()
+    app.logger.info("CSV data loading complete.")
 
 #still kinda async for report generation, trigger_report route/api
-scheduler = BackgroundScheduler()
-scheduler.start()
+#started on first use rather than at import, so report worker processes importing this module don't run their own
+scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    global scheduler
+    with _scheduler_lock:
+        if scheduler is None:
+            scheduler = BackgroundScheduler()
+            scheduler.start()
+        return scheduler
+
+#report_id -> (status, csv_path) for reports still being generated
+_report_state = {}
+_report_state_lock = threading.Lock()
 
 @app.route('/trigger_report', methods=['POST'])
 def trigger_report():
@@ -101,8 +234,9 @@ def trigger_report():
     db = get_db()
     db.execute('INSERT INTO reports (report_id, status) VALUES (?, ?)', (report_id, 'Running'))
     db.commit()
+    set_report_state(report_id, 'Running')
     
-    scheduler.add_job(generate_report, args=[report_id])
+    get_scheduler().add_job(generate_report, args=[report_id])
     
     return jsonify({"report_id": report_id})
 
@@ -112,13 +246,20 @@ def get_report():
     if not report_id:
         return "Missing report_id parameter", 400
 
-    db = get_db()
-    row = db.execute('SELECT status, csv_path FROM reports WHERE report_id = ?', (report_id,)).fetchone()
-    
-    if not row:
-        return "Report not found", 404
+    #polls are answered from memory, the db is only needed for reports from before a restart
+    with _report_state_lock:
+        state = _report_state.get(report_id)
+
+    if state is None:
+        db = get_db()
+        row = db.execute('SELECT status, csv_path FROM reports WHERE report_id = ?', (report_id,)).fetchone()
+        
+        if not row:
+            return "Report not found", 404
+
+        state = (row['status'], row['csv_path'])
 
-    status, csv_path = row['status'], row['csv_path']
+    status, csv_path = state
     
     if status == 'Running':
         return "Running"
@@ -131,16 +272,18 @@ def get_report():
         return "Error generating report", 500
 
 def generate_report(report_id):
+    csv_path = os.path.join(app.root_path, f"report_{report_id}.csv")
+    #rows are streamed while they're computed, so write to a temp file and only move it into place once complete
+    tmp_path = f"{csv_path}.tmp"
     try:
         db = get_db()
-        report_data = calculate_uptime_downtime(db)
-        csv_path = os.path.join(app.root_path, f"report_{report_id}.csv")
         
-        with open(csv_path, 'w', newline='') as csvfile:
+        with open(tmp_path, 'w', newline='') as csvfile:
             writer = csv.writer(csvfile)
             writer.writerow(['store_id', 'uptime_last_hour', 'uptime_last_day', 'uptime_last_week',
                              'downtime_last_hour', 'downtime_last_day', 'downtime_last_week'])
-            writer.writerows(report_data)
+            writer.writerows(calculate_uptime_downtime(db))
+        os.replace(tmp_path, csv_path)
 
         db.execute('UPDATE reports SET status = ?, csv_path = ? WHERE report_id = ?', 
                    ('Complete', csv_path, report_id))
@@ -148,29 +291,70 @@ def generate_report(report_id):
     except Exception as e:
         app.logger.error(f"Error generating report: {e}")
         app.logger.error(f"Traceback: {traceback.format_exc()}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         db.execute('UPDATE reports SET status = ? WHERE report_id = ?', ('Failed', report_id))
         db.commit()
+    finally:
+        #finished reports are served from the db, memory only covers the ones still running
+        clear_report_state(report_id)
+
+def set_report_state(report_id, status):
+    with _report_state_lock:
+        _report_state[report_id] = (status, None)
+
+def clear_report_state(report_id):
+    with _report_state_lock:
+        _report_state.pop(report_id, None)
 
 def calculate_uptime_downtime(db):
-    current_time_row = db.execute('SELECT MAX(timestamp_utc) FROM store_status').fetchone()
+    #one cursor for all the report queries, plain tuples instead of sqlite3.Row for the bulk reads
+    cursor = db.cursor()
+    cursor.row_factory = None
+    current_time_row = cursor.execute(LATEST_PING_SQL).fetchone()
     if not current_time_row or not current_time_row[0]:
         app.logger.error("No data found in store_status table")
-        return []
+        return
 
-    current_time = datetime.fromisoformat(current_time_row[0].rstrip('Z'))
-    
+    current_time = parse_timestamp(current_time_row[0])
+
+    #load everything once up front instead of querying per store, workers only get plain data
+    tz_map = load_timezones(cursor)
+    bh_map = load_business_hours(cursor)
+    status_map = load_store_pings(cursor, current_time - WEEK)
+
+    stores = [
+        (store_id, pings, tz_map.get(store_id, 'America/Chicago'), bh_map.get(store_id, []))
+        for store_id, pings in status_map.items()
+    ]
+    chunks = [stores[i:i + REPORT_CHUNK_SIZE] for i in range(0, len(stores), REPORT_CHUNK_SIZE)]
+
+    #stores are independent so chunks run in parallel worker processes, a single chunk isn't worth the pickling
+    if len(chunks) <= 1:
+        for rows in map(calculate_store_chunk, chunks, repeat(current_time)):
+            yield from rows
+        return
+
+    #rows are yielded as chunks finish so the csv writer can stream them
+    executor = get_report_executor()
+    try:
+        for rows in executor.map(calculate_store_chunk, chunks, repeat(current_time)):
+            yield from rows
+    except BrokenProcessPool:
+        #a dead worker breaks the pool for good, drop it so the next report gets a fresh one
+        reset_report_executor(executor)
+        raise
+
+def calculate_store_chunk(stores, current_time):
     report_data = []
-    stores = db.execute('SELECT DISTINCT store_id FROM store_status').fetchall()
-    
-    for store in stores:
-        store_id = store['store_id']
-        timezone = get_store_timezone(db, store_id)
-        business_hours = get_business_hours(db, store_id)
-        
+    for store_id, pings, timezone, business_hour_rows in stores:
         try:
-            uptime_last_hour, downtime_last_hour = calculate_time_range(db, store_id, current_time, timedelta(hours=1), timezone, business_hours)
-            uptime_last_day, downtime_last_day = calculate_time_range(db, store_id, current_time, timedelta(days=1), timezone, business_hours)
-            uptime_last_week, downtime_last_week = calculate_time_range(db, store_id, current_time, timedelta(weeks=1), timezone, business_hours)
+            #parsed per store so a malformed row only skips that store
+            business_hours = get_business_hours(business_hour_rows)
+            last_hour, last_day, last_week = calculate_time_ranges(pings, current_time, REPORT_WINDOWS, timezone, business_hours)
+            uptime_last_hour, downtime_last_hour = last_hour
+            uptime_last_day, downtime_last_day = last_day
+            uptime_last_week, downtime_last_week = last_week
             
             report_data.append([
                 store_id,
@@ -182,59 +366,189 @@ def calculate_uptime_downtime(db):
     
     return report_data
 
-def get_store_timezone(db, store_id):
-    row = db.execute('SELECT timezone_str FROM timezones WHERE store_id = ?', (store_id,)).fetchone()
-    return row['timezone_str'] if row else 'America/Chicago'
+def get_report_executor():
+    global _report_executor
+    #spawn rather than fork, the server forks from a process running request and scheduler threads
+    with _report_executor_lock:
+        if _report_executor is None:
+            _report_executor = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+        return _report_executor
+
+def reset_report_executor(executor):
+    global _report_executor
+    with _report_executor_lock:
+        if _report_executor is executor:
+            _report_executor = None
+    executor.shutdown(wait=False)
+
+def load_timezones(cursor):
+    return dict(cursor.execute(TIMEZONES_SQL))
+
+def load_business_hours(cursor):
+    bh_map = defaultdict(list)
+    for store_id, day_of_week, start_time_local, end_time_local in cursor.execute(BUSINESS_HOURS_SQL):
+        bh_map[store_id].append((day_of_week, start_time_local, end_time_local))
+    return bh_map
+
+def load_store_pings(cursor, since):
+    #pings from the last week plus each store's latest ping before it, so the status at the window start is known
+    #each store maps to parallel lists of sorted timestamps and active flags
+    status_map = defaultdict(lambda: ([], []))
+    rows = cursor.execute(STORE_PINGS_SQL, (format_timestamp(since), format_timestamp(since)))
+    for store_id, timestamp_utc, status in rows:
+        timestamps, statuses = status_map[store_id]
+        timestamps.append(parse_timestamp(timestamp_utc))
+        statuses.append(status == 'active')
+    return status_map
+
+def get_business_hours(rows):
+    #per weekday list of (open, close) in seconds since local midnight, closing past midnight runs over DAY
+    business_hours = [[] for _ in range(7)]
+    for day, start, end in rows:
+        if not 0 <= day < 7:
+            app.logger.warning(f"Ignoring business hours for invalid day {day}")
+            continue
+
+        start_sec, end_sec = parse_seconds(start), parse_seconds(end)
+        if end_sec == END_OF_DAY:
+            end_sec = DAY
+        elif end_sec < start_sec:
+            end_sec += DAY
+        business_hours[day].append((start_sec, end_sec))
 
-def get_business_hours(db, store_id):
-    rows = db.execute('SELECT * FROM business_hours WHERE store_id = ?', (store_id,)).fetchall()
-    if not rows:
-        return [(i, '00:00:00', '23:59:59') for i in range(7)]
-    
-    business_hours = [(row['day_of_week'], row['start_time_local'], row['end_time_local']) for row in rows]
     #logic for keeping 7 days
-    for i in range(7):
-        if not any(day[0] == i for day in business_hours):
-            business_hours.append((i, '00:00:00', '23:59:59'))
+    for hours in business_hours:
+        if not hours:
+            hours.append((0, DAY))
     
-    return sorted(business_hours)
+    return business_hours
 
-def calculate_time_range(db, store_id, end_time, duration, timezone, business_hours):
-    start_time = end_time - duration
-    local_tz = pytz.timezone(timezone)
-    
-    uptime = timedelta()
-    downtime = timedelta()
-    current_time = start_time
-    
-    while current_time < end_time:
-        local_time = current_time.astimezone(local_tz)
-        day_of_week = local_time.weekday()
-        
-        if day_of_week < len(business_hours):
-            if is_business_hours(local_time, business_hours[day_of_week]):
-                status = get_store_status(db, store_id, current_time)
-                if status == 'active':
-                    uptime += timedelta(hours=1)
-                else:
-                    downtime += timedelta(hours=1)
+@lru_cache(maxsize=512)
+def parse_seconds(value):
+    hours, minutes, seconds = map(int, value.split(':'))
+    return hours * HOUR + minutes * 60 + seconds
+
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    return pytz.timezone(name)
+
+def calculate_time_ranges(pings, end_time, durations, timezone, business_hours):
+    #all windows end at end_time, so intervals for the longest one cover the rest and one pass fills every window
+    start_time = end_time - max(durations)
+    window_starts = [end_time - duration for duration in durations]
+
+    #stores open around the clock (the default when no hours are given) skip the timezone and interval work
+    if business_hours == ALWAYS_OPEN:
+        intervals = [(start_time, end_time)]
+    else:
+        intervals = get_business_intervals(start_time, end_time, get_timezone(timezone), business_hours)
+    uptime, downtime = integrate_status(pings, start_time, end_time, intervals, window_starts)
+
+    return [(round(up / 60, 2), round(down / 60, 2)) for up, down in zip(uptime, downtime)]
+
+def integrate_status(pings, start_time, end_time, intervals, window_starts):
+    #status holds from one ping until the next, before the first ping the store counts as inactive
+    #pings and intervals are both sorted so one pass with two pointers covers everything
+    timestamps, statuses = pings
+    uptime = [0] * len(window_starts)
+    downtime = [0] * len(window_starts)
+
+    #no ping inside the window means one status holds for all of it, so just total the open time
+    if not timestamps or timestamps[-1] <= start_time:
+        totals = uptime if timestamps and statuses[-1] else downtime
+        for open_at, close_at in intervals:
+            add_overlap(totals, window_starts, open_at, close_at)
+        return uptime, downtime
+
+    first = max(bisect_right(timestamps, start_time) - 1, 0)
+    last = bisect_right(timestamps, end_time)
+
+    j = 0
+    for i in range(first - 1, last):
+        seg_start = start_time if i < first else max(timestamps[i], start_time)
+        seg_end = timestamps[i + 1] if i + 1 < last else end_time
+        totals = uptime if i >= first and statuses[i] else downtime
+        if seg_end <= seg_start:
+            continue
+
+        while j < len(intervals) and intervals[j][1] <= seg_start:
+            j += 1
+        k = j
+        while k < len(intervals) and intervals[k][0] < seg_end:
+            add_overlap(totals, window_starts, max(seg_start, intervals[k][0]), min(seg_end, intervals[k][1]))
+            k += 1
+
+    return uptime, downtime
+
+def add_overlap(totals, window_starts, open_at, close_at):
+    #credit the part of [open_at, close_at) that falls inside each window
+    for w, window_start in enumerate(window_starts):
+        if close_at > window_start:
+            totals[w] += close_at - max(open_at, window_start)
+
+def get_business_intervals(start_time, end_time, local_tz, business_hours):
+    #business hours as utc intervals clipped to the window, days run one extra on each side for cross-midnight/offsets
+    #local time is utc + offset, when no dst change falls near the window one offset covers every interval
+    first_offset = get_utc_offset(local_tz, start_time - 2 * DAY)
+    last_offset = get_utc_offset(local_tz, end_time + 2 * DAY)
+    fixed_offset = first_offset if first_offset == last_offset else None
+
+    intervals = []
+    first_day = (start_time + first_offset) // DAY - 1
+    last_day = (end_time + last_offset) // DAY + 1
+    for day in range(first_day, last_day + 1):
+        midnight = day * DAY
+        #day 0 (1970-01-01) was a thursday
+        for start_sec, end_sec in business_hours[(day + 3) % 7]:
+            if fixed_offset is not None:
+                open_at = midnight + start_sec - fixed_offset
+                close_at = midnight + end_sec - fixed_offset
+            else:
+                open_at = local_to_utc(local_tz, midnight + start_sec)
+                close_at = local_to_utc(local_tz, midnight + end_sec)
+
+            open_at, close_at = max(open_at, start_time), min(close_at, end_time)
+            if open_at < close_at:
+                intervals.append((open_at, close_at))
+
+    #merge overlaps (e.g. a cross-midnight shift running into the next day's hours) so time isn't counted twice
+    merged = []
+    for open_at, close_at in sorted(intervals):
+        if merged and open_at <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], close_at))
         else:
-            app.logger.warning(f"Missing business hours for day {day_of_week} for store {store_id}")
-        
-        current_time += timedelta(hours=1)
-    
-    return uptime.total_seconds() / 60, downtime.total_seconds() / 60
+            merged.append((open_at, close_at))
+
+    return merged
+
+def get_utc_offset(local_tz, timestamp):
+    return int(datetime.fromtimestamp(timestamp, local_tz).utcoffset().total_seconds())
+
+def local_to_utc(local_tz, local_seconds):
+    naive = LOCAL_EPOCH + timedelta(seconds=local_seconds)
+    try:
+        return int(local_tz.localize(naive, is_dst=None).timestamp())
+    except pytz.AmbiguousTimeError:
+        return int(local_tz.localize(naive, is_dst=False).timestamp())
+    except pytz.NonExistentTimeError:
+        #a time skipped by a dst jump is reached when the clock jumps, find that instant between the two readings
+        low = int(local_tz.localize(naive, is_dst=True).timestamp())
+        high = int(local_tz.localize(naive, is_dst=False).timestamp())
+        offset_before = get_utc_offset(local_tz, low)
+        while low < high:
+            mid = (low + high) // 2
+            if get_utc_offset(local_tz, mid) == offset_before:
+                low = mid + 1
+            else:
+                high = mid
+        return low
 
-def is_business_hours(local_time, business_hours):
-    day_of_week, start_time, end_time = business_hours
-    start_time = datetime.strptime(start_time, '%H:%M:%S').time()
-    end_time = datetime.strptime(end_time, '%H:%M:%S').time()
-    return start_time <= local_time.time() <= end_time
+def parse_timestamp(value):
+    return int(datetime.fromisoformat(value.rstrip('Z')).replace(tzinfo=pytz.utc).timestamp())
 
-def get_store_status(db, store_id, timestamp):
-    row = db.execute('SELECT status FROM store_status WHERE store_id = ? AND timestamp_utc <= ? ORDER BY timestamp_utc DESC LIMIT 1',
-                     (store_id, timestamp.isoformat() + 'Z')).fetchone()
-    return row['status'] if row else 'inactive'
+def format_timestamp(value):
+    return datetime.fromtimestamp(value, pytz.utc).strftime('%Y-%m-%d %H:%M:%S')
 
 if __name__ == '__main__':
+    ensure_db()
     app.run(debug=True)
\ No newline at end of file
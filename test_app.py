@@ -0,0 +1,175 @@
+import random
+import sqlite3
+import time
+from bisect import bisect_right
+from datetime import datetime
+
+import pytz
+
+import app
+
+TIMEZONES = ['America/New_York', 'America/Chicago', 'Europe/London', 'Australia/Lord_Howe', 'Asia/Kolkata', 'UTC']
+
+#utc instants of dst changes in the zones above during 2024
+DST_CHANGES = [1710054000, 1730613600, 1711846800, 1729990800, 1712415600, 1728142200]
+
+#business hour boundaries outside 01:00-03:00, where these zones have skipped or repeated local times
+SAFE_TIMES = ['00:00:00', '00:30:00', '03:00:00', '04:15:00', '06:00:00', '08:00:00', '09:30:00',
+              '12:00:00', '17:45:00', '20:00:00', '22:00:00', '23:30:00']
+
+def utc(*args):
+    return int(datetime(*args, tzinfo=pytz.utc).timestamp())
+
+def to_seconds(value):
+    hours, minutes, seconds = map(int, value.split(':'))
+    return hours * 3600 + minutes * 60 + seconds
+
+def reference_minutes(pings, end_time, timezone, rows):
+    #independent per-minute walk over the last week, checking wall-clock local time against the raw hours
+    local_tz = pytz.timezone(timezone)
+    hours = {day: [] for day in range(7)}
+    for day, start, end in rows:
+        end_sec = app.DAY if end == '23:59:59' else to_seconds(end)
+        hours[day].append((to_seconds(start), end_sec))
+    for day in hours:
+        if not hours[day]:
+            hours[day] = [(0, app.DAY)]
+
+    def is_open(timestamp):
+        local = datetime.fromtimestamp(timestamp, local_tz)
+        time_of_day = local.hour * 3600 + local.minute * 60 + local.second
+        for start, end in hours[local.weekday()]:
+            if start <= time_of_day < end or (end < start and time_of_day >= start):
+                return True
+        #shifts from the previous day that run past midnight
+        return any(end < start and time_of_day < end for start, end in hours[(local.weekday() - 1) % 7])
+
+    ping_times = [timestamp for timestamp, _ in pings]
+    totals = {window: [0, 0] for window in app.REPORT_WINDOWS}
+    for timestamp in range(end_time - app.WEEK, end_time, 60):
+        if not is_open(timestamp):
+            continue
+
+        i = bisect_right(ping_times, timestamp) - 1
+        active = i >= 0 and pings[i][1] == 'active'
+        for window in app.REPORT_WINDOWS:
+            if timestamp >= end_time - window:
+                totals[window][0 if active else 1] += 1
+
+    return [tuple(totals[window]) for window in app.REPORT_WINDOWS]
+
+def calculate(pings, end_time, timezone, rows):
+    timestamps = [timestamp for timestamp, _ in pings]
+    statuses = [status == 'active' for _, status in pings]
+    return app.calculate_time_ranges((timestamps, statuses), end_time, app.REPORT_WINDOWS, timezone,
+                                     app.get_business_hours(rows))
+
+def random_rows(rng):
+    rows = []
+    for day in rng.sample(range(7), rng.randint(0, 7)):
+        for _ in range(rng.randint(1, 2)):
+            start = rng.choice(SAFE_TIMES)
+            end = rng.choice([time for time in SAFE_TIMES + ['23:59:59'] if time != start])
+            rows.append((day, start, end))
+    return rows
+
+def test_matches_per_minute_reference():
+    rng = random.Random(1234)
+    for _ in range(150):
+        timezone = rng.choice(TIMEZONES)
+        if rng.random() < 0.5:
+            end_time = rng.choice(DST_CHANGES) + rng.randint(-8, 8) * app.DAY + rng.randint(0, 1439) * 60
+        else:
+            end_time = utc(2024, 1, 1) + rng.randint(0, 365 * 1440) * 60
+
+        ping_times = sorted(set(end_time - rng.randint(0, 9 * 1440) * 60 for _ in range(rng.randint(0, 30))))
+        pings = [(timestamp, rng.choice(['active', 'inactive'])) for timestamp in ping_times]
+        rows = random_rows(rng)
+
+        expected = reference_minutes(pings, end_time, timezone, rows)
+        assert calculate(pings, end_time, timezone, rows) == expected, (timezone, end_time, pings, rows)
+
+def test_end_of_day_close_counts_until_midnight():
+    rows = [(day, '08:00:00', '23:59:59') for day in range(7)]
+    pings = [(utc(2024, 5, 1), 'active')]
+    assert calculate(pings, utc(2024, 5, 13), 'UTC', rows)[2] == (16 * 60 * 7, 0)
+
+def test_cross_midnight_hours():
+    rows = [(day, '22:00:00', '02:00:00') for day in range(7)]
+    pings = [(utc(2024, 5, 1), 'active'), (utc(2024, 5, 12, 23), 'inactive')]
+    #the window ends sunday midnight: saturday's shift runs into sunday until 02:00, sunday's is cut at midnight
+    #and goes inactive at 23:00, the week also picks up the previous sunday's shift after monday 00:00
+    _, last_day, last_week = calculate(pings, utc(2024, 5, 13), 'UTC', rows)
+    assert last_day == (120 + 60, 60)
+    assert last_week == (120 + 6 * 240 + 60, 60)
+
+def test_hours_inside_dst_gap_start_when_the_clock_jumps():
+    #2024-03-10 new york skips 02:00-03:00 local, an opening at 02:30 takes effect at 03:00 edt (07:00 utc)
+    end_time = utc(2024, 3, 10, 16)
+    pings = [(utc(2024, 3, 1), 'active')]
+
+    #saturday is open all day: 16:00 utc until local midnight at 05:00 utc, then sunday 07:00-14:00 utc
+    rows = [(6, '02:30:00', '10:00:00')]
+    assert calculate(pings, end_time, 'America/New_York', rows)[1] == (13 * 60 + 7 * 60, 0)
+    assert calculate(pings, end_time, 'America/New_York', rows) == reference_minutes(pings, end_time, 'America/New_York', rows)
+
+    #a close inside the gap ends at the jump too: sunday 05:00-07:00 utc
+    rows = [(6, '00:00:00', '02:30:00')]
+    assert calculate(pings, end_time, 'America/New_York', rows)[1] == (13 * 60 + 2 * 60, 0)
+    assert calculate(pings, end_time, 'America/New_York', rows) == reference_minutes(pings, end_time, 'America/New_York', rows)
+
+def test_load_csv_data_skips_blank_lines_and_pads_short_rows(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    #more rows than one multi-row insert holds, so the batch boundary is crossed
+    row_count = 2 * (app.SQLITE_MAX_VARIABLES // 3) + 7
+    lines = ['store_id,timestamp_utc,status']
+    for i in range(row_count):
+        lines.append(f'{i},2024-09-22 10:00:00,active')
+        if i % 100 == 0:
+            lines.append('')
+    lines.append('short,2024-09-22 11:00:00')
+    (tmp_path / 'store_status.csv').write_text('\n'.join(lines) + '\n')
+    (tmp_path / 'timezones.csv').write_text('store_id,timezone_str\n\n1,America/New_York\n')
+
+    db = sqlite3.connect(tmp_path / 'test.db')
+    app.create_tables(db)
+    app.load_csv_data(db)
+
+    assert db.execute('SELECT COUNT(*) FROM store_status').fetchone()[0] == row_count + 1
+    assert db.execute('SELECT COUNT(DISTINCT store_id) FROM store_status').fetchone()[0] == row_count + 1
+    assert db.execute("SELECT status FROM store_status WHERE store_id = 'short'").fetchone() == (None,)
+    assert db.execute('SELECT * FROM timezones').fetchall() == [('1', 'America/New_York')]
+
+def test_malformed_business_hours_only_skip_that_store():
+    pings = ([utc(2024, 5, 1)], [True])
+    stores = [
+        ('bad_time', pings, 'UTC', [(3, '9:00', '17:00:00')]),
+        ('null_time', pings, 'UTC', [(3, None, '17:00:00')]),
+        ('good', pings, 'UTC', [(3, '09:00:00', '17:00:00')]),
+    ]
+    rows = app.calculate_store_chunk(stores, utc(2024, 5, 13))
+    assert [row[0] for row in rows] == ['good']
+
+def test_trigger_report_works_without_running_as_main(tmp_path, monkeypatch):
+    #as under flask run or a wsgi server: the module is only imported, db and scheduler come up on first use
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, '_db_ready', False)
+    monkeypatch.setattr(app, 'scheduler', None)
+    monkeypatch.setattr(app.app, 'root_path', str(tmp_path))
+    (tmp_path / 'store_status.csv').write_text(
+        'store_id,timestamp_utc,status\n1,2024-09-22 10:00:00,inactive\n1,2024-09-22 11:00:00,active\n')
+
+    client = app.app.test_client()
+    try:
+        report_id = client.post('/trigger_report').get_json()['report_id']
+        for _ in range(100):
+            response = client.get(f'/get_report?report_id={report_id}')
+            if response.data != b'Running':
+                break
+            time.sleep(0.05)
+    finally:
+        app.scheduler.shutdown()
+
+    #the report ends at the latest ping, so every window is inactive up to it and the store is open 24/7
+    assert response.status_code == 200
+    assert response.data.decode().splitlines()[1] == '1,0.0,0.0,0.0,60.0,1440.0,10080.0'